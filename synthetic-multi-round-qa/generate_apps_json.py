@@ -1,25 +1,334 @@
-import json
+import os
+import gzip
 import random
 import string
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
 
-def random_string(length):
-    """Generate a random string of fixed length."""
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+try:
+    import numpy as np
+except ImportError:
+    # Fall back to the stdlib generator below
+    np = None
 
-def generate_random_app(sys_prompt_len, tools_len, rag_doc_len, rag_doc_count):
-    """Generate a random App object."""
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Characters random strings are drawn from. Two letters are repeated to pad the
+# alphabet to 64 characters, so that a random byte maps to a character without
+# any rejection or modulo
+_ALPHABET = (string.ascii_letters + string.digits + "xy").encode()
+
+# Maps every byte value b to _ALPHABET[b & 63], usable with bytes.translate
+_BYTE_TO_CHAR_TABLE = bytes(_ALPHABET[b & 63] for b in range(256))
+
+if np is not None:
+    _BYTE_TO_CHAR = np.frombuffer(_BYTE_TO_CHAR_TABLE, dtype=np.uint8)
+
+# Number of apps whose characters are drawn from the RNG at once; bounds memory for large fixtures
+_APPS_PER_DRAW = 64
+
+# Size of the output file buffer, large enough to hold a few apps with the default lengths
+_WRITE_BUFFER_SIZE = 1 << 20
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False)
+    def _fill_random_chars(out, byte_to_char, state):
+        """Fill out with random characters using an xorshift64* generator.
+
+        Fuses the random draw and the character lookup into one loop, so no
+        intermediate byte array is needed. state holds the generator state
+        and is updated in place.
+        """
+        x = state[0]
+        for i in range(out.size):
+            x ^= x >> np.uint64(12)
+            x ^= x << np.uint64(25)
+            x ^= x >> np.uint64(27)
+            out[i] = byte_to_char[(x * np.uint64(0x2545F4914F6CDD1D)) >> np.uint64(56)]
+        state[0] = x
+else:
+    _fill_random_chars = None
+
+class _RandomChars:
+    """Fills uint8 arrays with random alphabet characters drawn from rng."""
+
+    def __init__(self, rng):
+        self._rng = rng
+        # xorshift state for the numba kernel, which must never be zero
+        self._state = rng.integers(1, np.iinfo(np.uint64).max, size=1, dtype=np.uint64, endpoint=True)
+
+    def fill(self, chars):
+        if _fill_random_chars is not None:
+            _fill_random_chars(chars.reshape(-1), _BYTE_TO_CHAR, self._state)
+        else:
+            # Raw bytes are the cheapest thing to draw; the lookup table absorbs the range reduction
+            raw = np.frombuffer(self._rng.bytes(chars.size), dtype=np.uint8).reshape(chars.shape)
+            _BYTE_TO_CHAR.take(raw, out=chars)
+
+def generate_random_app(chars, sys_prompt_len, tools_len, rag_docs):
+    """Build an App object from one row of random alphabet characters and its RAG documents.
+
+    The values are uint8 arrays (views into chars) rather than strings, so they
+    can be spliced into the output without decoding and re-encoding them.
+    """
     return {
-        "systemPrompt": random_string(sys_prompt_len),
-        "tools": random_string(tools_len),
-        "ragDocs": [random_string(rag_doc_len) for _ in range(rag_doc_count)]
+        "systemPrompt": chars[:sys_prompt_len],
+        "tools": chars[sys_prompt_len:sys_prompt_len + tools_len],
+        "ragDocs": rag_docs
     }
 
-def generate_apps_json(num_apps, sys_prompt_len, tools_len, rag_doc_len, rag_doc_count, output_file):
-    """Generate a JSON array of random Apps."""
-    apps = [generate_random_app(sys_prompt_len, tools_len, rag_doc_len, rag_doc_count) for _ in range(num_apps)]
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(apps, f, indent=4)
+@dataclass(frozen=True)
+class _JsonLayout:
+    """Constant byte fragments spliced between the random strings in the output.
+
+    Every App has the same structure, so its JSON is fully determined by these
+    fragments and the random strings, with no per-app formatting work.
+    """
+    array_start: bytes
+    array_end: bytes
+    app_separator: bytes
+    # Fragments of an app, in output order
+    app_start: bytes
+    before_tools: bytes
+    before_rag_docs: bytes
+    doc_separator: bytes
+    app_end: bytes
+    # Replaces before_rag_docs ... app_end for an app without RAG documents
+    app_end_without_rag_docs: bytes
+
+_PRETTY_LAYOUT = _JsonLayout(
+    array_start=b'[\n',
+    array_end=b'\n]',
+    app_separator=b',\n',
+    app_start=b'  {\n    "systemPrompt": "',
+    before_tools=b'",\n    "tools": "',
+    before_rag_docs=b'",\n    "ragDocs": [\n      "',
+    doc_separator=b'",\n      "',
+    app_end=b'"\n    ]\n  }',
+    app_end_without_rag_docs=b'",\n    "ragDocs": [\n    ]\n  }',
+)
+
+_COMPACT_LAYOUT = _JsonLayout(
+    array_start=b'[',
+    array_end=b']',
+    app_separator=b',',
+    app_start=b'{"systemPrompt":"',
+    before_tools=b'","tools":"',
+    before_rag_docs=b'","ragDocs":["',
+    doc_separator=b'","',
+    app_end=b'"]}',
+    app_end_without_rag_docs=b'","ragDocs":[]}',
+)
+
+# One compact JSON object per line
+_NDJSON_LAYOUT = replace(_COMPACT_LAYOUT, array_start=b'', array_end=b'\n', app_separator=b'\n')
+
+def _get_layout(output_format, pretty):
+    """Pick the layout for an output format ("json" or "ndjson")."""
+    if output_format == "ndjson":
+        return _NDJSON_LAYOUT
+    return _PRETTY_LAYOUT if pretty else _COMPACT_LAYOUT
+
+def _serialize_app(app, layout, buf):
+    """Append one App object to buf as JSON using the given layout.
+
+    The strings only contain alphabet characters, none of which needs escaping,
+    so they are copied verbatim instead of going through a JSON encoder.
+    """
+    buf.extend(layout.app_start)
+    buf.extend(app["systemPrompt"])
+    buf.extend(layout.before_tools)
+    buf.extend(app["tools"])
+    if len(app["ragDocs"]) == 0:
+        buf.extend(layout.app_end_without_rag_docs)
+        return
+    buf.extend(layout.before_rag_docs)
+    buf.extend(layout.doc_separator.join(app["ragDocs"]))
+    buf.extend(layout.app_end)
+
+def _random_chars_stdlib(rng, length):
+    """Generate length random alphabet characters as bytes using a random.Random instance."""
+    if length == 0:
+        # getrandbits(0) raises ValueError before Python 3.9
+        return b""
+    # Same as rng.randbytes(length), which needs Python 3.9
+    return rng.getrandbits(8 * length).to_bytes(length, "little").translate(_BYTE_TO_CHAR_TABLE)
+
+def _iter_random_apps_stdlib(num_apps, sys_prompt_len, tools_len, rag_doc_len, rag_doc_count, rng, rag_pool=None):
+    """Pure-Python version of iter_random_apps, used when NumPy is not installed."""
+    tools_end = sys_prompt_len + tools_len
+    total_per_app = tools_end if rag_pool is not None else tools_end + rag_doc_count * rag_doc_len
+    for _ in range(num_apps):
+        chars = memoryview(_random_chars_stdlib(rng, total_per_app))
+        if rag_pool is None:
+            rag_docs = [chars[tools_end + i * rag_doc_len:tools_end + (i + 1) * rag_doc_len]
+                        for i in range(rag_doc_count)]
+        else:
+            rag_docs = rng.sample(rag_pool, rag_doc_count)
+        yield generate_random_app(chars, sys_prompt_len, tools_len, rag_docs)
+
+def iter_random_apps(num_apps, sys_prompt_len, tools_len, rag_doc_len, rag_doc_count, rng, rag_pool=None):
+    """Lazily generate random App objects, drawing their characters in blocks of apps.
+
+    If rag_pool is given, every app samples its RAG documents from the rows of
+    that array instead of drawing new ones.
+
+    The yielded apps are views into a buffer that is overwritten by the next
+    block, so each app must be consumed before the generator is advanced.
+    """
+    if np is None:
+        yield from _iter_random_apps_stdlib(num_apps, sys_prompt_len, tools_len, rag_doc_len, rag_doc_count, rng,
+                                            rag_pool)
+        return
+    tools_end = sys_prompt_len + tools_len
+    total_per_app = tools_end if rag_pool is not None else tools_end + rag_doc_count * rag_doc_len
+    random_chars = _RandomChars(rng)
+    # Reused by every block of apps
+    scratch = np.empty((min(_APPS_PER_DRAW, num_apps), total_per_app), dtype=np.uint8)
+    for block_start in range(0, num_apps, _APPS_PER_DRAW):
+        block_size = min(_APPS_PER_DRAW, num_apps - block_start)
+        # Draw the characters of the whole block in a single call, one row per app
+        chars = scratch[:block_size]
+        random_chars.fill(chars)
+        for row in chars:
+            if rag_pool is None:
+                rag_docs = row[tools_end:].reshape(rag_doc_count, rag_doc_len)
+            else:
+                rag_docs = [rag_pool[i] for i in rng.choice(len(rag_pool), rag_doc_count, replace=False)]
+            yield generate_random_app(row, sys_prompt_len, tools_len, rag_docs)
+
+def _serialize_apps_chunk(chunk_args):
+    """Generate a chunk of apps and serialize them as separated JSON objects."""
+    num_apps, sys_prompt_len, tools_len, rag_doc_len, rag_doc_count, rag_pool, layout, seed = chunk_args
+    rng = _new_rng(seed)
+    apps = iter_random_apps(num_apps, sys_prompt_len, tools_len, rag_doc_len, rag_doc_count, rng, rag_pool)
+    buf = bytearray()
+    for i, app in enumerate(apps):
+        if i > 0:
+            buf.extend(layout.app_separator)
+        _serialize_app(app, layout, buf)
+    return buf
+
+def _spawn_seeds(seed, count):
+    """Derive count independent seeds from seed, for the generators created by _new_rng."""
+    if np is None:
+        return [None if seed is None else f"{seed}/{i}" for i in range(count)]
+    return np.random.SeedSequence(seed).spawn(count)
+
+def _new_rng(seed):
+    if np is None:
+        return random.Random(seed)
+    return np.random.default_rng(seed)
+
+def _random_rag_pool(rag_pool_size, rag_doc_len, seed):
+    """Generate the RAG documents shared by all apps, as rows of a uint8 array (or a list of bytes without NumPy)."""
+    rng = _new_rng(seed)
+    if np is None:
+        return [_random_chars_stdlib(rng, rag_doc_len) for _ in range(rag_pool_size)]
+    rag_pool = np.empty((rag_pool_size, rag_doc_len), dtype=np.uint8)
+    _RandomChars(rng).fill(rag_pool)
+    return rag_pool
+
+def _write_chunks(f, chunks, layout):
+    """Write serialized chunks of apps as the elements of a JSON array, or as NDJSON lines."""
+    f.write(layout.array_start)
+    for i, chunk in enumerate(chunks):
+        if i > 0:
+            f.write(layout.app_separator)
+        f.write(chunk)
+    f.write(layout.array_end)
+
+class _DirectIOWriter:
+    """Binary file writer that bypasses the page cache with O_DIRECT.
+
+    Data is collected in a page-aligned buffer and written in full blocks;
+    the unaligned tail is written with O_DIRECT switched off on close.
+    """
+
+    def __init__(self, path, block_size=_WRITE_BUFFER_SIZE):
+        # Imported here, so that the default buffered path also runs where they
+        # do not exist
+        import fcntl
+        import mmap
+
+        self._fcntl = fcntl
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+        # Anonymous mmaps are page-aligned, as O_DIRECT requires
+        self._block = mmap.mmap(-1, block_size)
+        self._view = memoryview(self._block)
+        self._filled = 0
+
+    def _write_all(self, data):
+        while data:
+            data = data[os.write(self._fd, data):]
+
+    def write(self, data):
+        data = memoryview(data)
+        while data:
+            n = min(len(data), len(self._block) - self._filled)
+            self._view[self._filled:self._filled + n] = data[:n]
+            self._filled += n
+            data = data[n:]
+            if self._filled == len(self._block):
+                self._write_all(self._view)
+                self._filled = 0
+
+    def close(self):
+        if self._filled:
+            fcntl = self._fcntl
+            flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            self._write_all(self._view[:self._filled])
+        self._view.release()
+        self._block.close()
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def generate_apps_json(num_apps, sys_prompt_len, tools_len, rag_doc_len, rag_doc_count, output_file, workers=None,
+                       pretty=False, seed=None, output_format="json", direct_io=False, rag_pool_size=None,
+                       compress=False):
+    """Generate a JSON array (or NDJSON file) of random Apps, writing each chunk of apps as soon as it is generated.
+
+    If rag_pool_size is given, only that many distinct RAG documents are
+    generated and shared between the apps; otherwise every document is unique.
+    If compress is set, the output is gzip-compressed and ".gz" is appended to output_file.
+    """
+    layout = _get_layout(output_format, pretty)
+    chunk_starts = range(0, num_apps, _APPS_PER_DRAW)
+    # Every chunk gets its own child seed, so the output only depends on the seed and not on the worker count.
+    # The extra last child seeds the RAG document pool
+    seeds = _spawn_seeds(seed, len(chunk_starts) + 1)
+    rag_pool = None
+    if rag_pool_size is not None:
+        rag_pool = _random_rag_pool(rag_pool_size, rag_doc_len, seeds[-1])
+    chunk_args = [
+        (min(_APPS_PER_DRAW, num_apps - start), sys_prompt_len, tools_len, rag_doc_len, rag_doc_count, rag_pool,
+         layout, chunk_seed)
+        for start, chunk_seed in zip(chunk_starts, seeds)
+    ]
+    if compress:
+        # The fastest level: it still squeezes out most of the JSON structure and indentation
+        output = gzip.open(output_file + ".gz", "wb", compresslevel=1)
+    elif direct_io:
+        output = _DirectIOWriter(output_file)
+    else:
+        output = open(output_file, "wb", buffering=_WRITE_BUFFER_SIZE)
+    with output as f:
+        if workers == 1 or len(chunk_args) <= 1:
+            _write_chunks(f, map(_serialize_apps_chunk, chunk_args), layout)
+        else:
+            # Apps are independent, so chunks are generated in parallel and written in order
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                _write_chunks(f, executor.map(_serialize_apps_chunk, chunk_args), layout)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate random Apps JSON file")
@@ -28,9 +337,27 @@ if __name__ == "__main__":
     parser.add_argument("--tools-len", type=int, default=200, help="Length of tools strings")
     parser.add_argument("--rag-doc-len", type=int, default=1000, help="Length of each RAG document")
     parser.add_argument("--rag-doc-count", type=int, default=10, help="Number of RAG documents per app")
+    parser.add_argument("--rag-pool-size", type=int, default=None,
+                        help="Sample RAG documents from a pool of this many shared documents (default: all unique)")
     parser.add_argument("--output", type=str, default="Apps.json", help="Output filename")
+    parser.add_argument("--pretty", action="store_true", help="Indent the output JSON instead of writing it compactly")
+    parser.add_argument("--format", type=str, choices=["json", "ndjson"], default="json",
+                        help="Write a JSON array, or one JSON object per line")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the random generator, for reproducible output "
+                        "(which also depends on whether numba and NumPy are installed)")
+    parser.add_argument("--direct-io", action="store_true",
+                        help="Write the output with O_DIRECT, bypassing the page cache (Linux only)")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Compress the output with gzip, appending .gz to the output filename")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)")
     
     args = parser.parse_args()
+    if args.pretty and args.format == "ndjson":
+        parser.error("--pretty cannot be used with --format ndjson")
+    if args.gzip and args.direct_io:
+        parser.error("--gzip cannot be used with --direct-io")
+    if args.rag_pool_size is not None and args.rag_pool_size < args.rag_doc_count:
+        parser.error("--rag-pool-size must be at least --rag-doc-count")
     
     generate_apps_json(
         args.num_apps,
@@ -38,5 +365,12 @@ if __name__ == "__main__":
         args.tools_len,
         args.rag_doc_len,
         args.rag_doc_count,
-        args.output
+        args.output,
+        workers=args.workers,
+        pretty=args.pretty,
+        seed=args.seed,
+        output_format=args.format,
+        direct_io=args.direct_io,
+        rag_pool_size=args.rag_pool_size,
+        compress=args.gzip,
     ) 
\ No newline at end of file
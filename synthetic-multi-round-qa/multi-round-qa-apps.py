@@ -1,18 +1,45 @@
 import argparse
 import asyncio
+import concurrent.futures
+import functools
+import gzip
+import hashlib
 import json
 import logging
 import random
 import time
-from dataclasses import dataclass
-from typing import Optional, List, Dict
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from typing import Callable, Optional, List, Dict
 
-import openai
+import aiohttp
+import numpy as np
+import orjson
 import pandas as pd
 
 from utils import AsyncLoopWrapper, init_logger
 
 logger = init_logger(__name__, logging.INFO)
+# init_logger leaves the logger itself at DEBUG, so the per-request debug
+# records would still be built and passed on to any root handler
+logger.setLevel(logging.INFO)
+
+_ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+_RANDOM_STRING_LEN = 200
+# Random strings of the questions are slices of this pool, so that they are cheap to build
+_RAND_POOL = "".join(random.choices(_ALPHABET, k=65536))
+
+
+@functools.lru_cache(maxsize=64)
+def _dummy_text(length: int) -> str:
+    return " ".join(["hi"] * length)
+
+
+@functools.lru_cache(maxsize=64)
+def _dummy_system_prompt_prefix(system_prompt_len: int) -> str:
+    # Shared by all users of a workload, only the user part of the prompt differs
+    return f"Hi, here's some system prompt: {_dummy_text(system_prompt_len)}."
+
 
 @dataclass
 class App:
@@ -20,18 +47,34 @@ class App:
     tools: str
     ragDocs: List[str]
 
+    # Prompt prefix shared by every request of the app's users, built once
+    joined_rag_docs: str = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.joined_rag_docs = "\n".join(self.ragDocs)
+
 
 class AppsManager:
     def __init__(self, apps_file_path: str, users_per_app: int = 2):
         self.apps = []
-        self.user_app_map: Dict[int, App] = {}
         self.users_per_app = users_per_app
         self._load_apps(apps_file_path)
 
     def _load_apps(self, file_path: str):
         try:
-            with open(file_path, "r", encoding="utf-8") as file:
-                apps_data = json.load(file)
+            if file_path.endswith(".gz"):
+                # Written by generate_apps_json.py --gzip
+                file_opener = gzip.open
+                data_path = file_path[:-len(".gz")]
+            else:
+                file_opener = open
+                data_path = file_path
+            with file_opener(file_path, "rt", encoding="utf-8") as file:
+                if data_path.endswith((".ndjson", ".jsonl")):
+                    # One app per line, as written by generate_apps_json.py --format ndjson
+                    apps_data = (json.loads(line) for line in file if line.strip())
+                else:
+                    apps_data = json.load(file)
                 for app_data in apps_data:
                     self.apps.append(
                         App(
@@ -45,16 +88,9 @@ class AppsManager:
             logger.error(f"Failed to load apps from {file_path}: {e}")
             raise
 
-    def assign_app_to_user(self, user_id: int):
-        # Assign the same app to every users_per_app users
-        app_index = (user_id // self.users_per_app) % len(self.apps)
-        self.user_app_map[user_id] = self.apps[app_index]
-        return self.apps[app_index]
-
     def get_app_for_user(self, user_id: int) -> App:
-        if user_id not in self.user_app_map:
-            return self.assign_app_to_user(user_id)
-        return self.user_app_map[user_id]
+        # The same app for every users_per_app users
+        return self.apps[(user_id // self.users_per_app) % len(self.apps)]
 
 @dataclass
 class WorkloadConfig:
@@ -104,7 +140,7 @@ class UserConfig:
     answer_len: int
 
     # Gap between two requests
-    gap_between_requests: int
+    gap_between_requests: float
 
     # Num rounds
     num_rounds: int
@@ -119,7 +155,7 @@ class UserConfig:
             system_prompt_len=workload_config.system_prompt_len,
             user_info_len=workload_config.user_info_len,
             answer_len=workload_config.answer_len,
-            gap_between_requests=workload_config.num_users / workload_config.qps,
+            gap_between_requests=workload_config.num_users / float(workload_config.qps),
             num_rounds=workload_config.num_rounds,
             enable_user_id=workload_config.enable_user_id,
         )
@@ -132,8 +168,12 @@ class ChatHistory:
     ):
         self.history = []
 
+    def on_system_prompt(self, prompt: str):
+        assert len(self.history) == 0, "Expect system prompt to come first"
+        self.history.append({"role": "system", "content": prompt})
+
     def on_user_query(self, query: str):
-        if len(self.history) == 0:
+        if len(self.history) == 0 or self.history[-1]["role"] == "system":
             self.history.append({"role": "user", "content": query})
         else:
             assert self.history[-1]["role"] == "assistant", "Expect system response"
@@ -160,96 +200,157 @@ class Response:
     generation_tokens: int
     launch_time: float
     finish_time: float
+    # Answered from the client-side response cache, without reaching the server
+    cached: bool = False
 
 
 class RequestExecutor:
+    # Number of distinct prompts whose responses are kept in the response cache
+    RESPONSE_CACHE_SIZE = 1024
 
-    def __init__(self, base_url: str, model: str):
+    # One connection pool shared by all the executors, closed with the last one
+    _session: Optional[aiohttp.ClientSession] = None
+    _session_users = 0
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        tokenizer_name: Optional[str] = None,
+        cache_identical: bool = False,
+    ):
         # Ensure base_url ends with /v1
         if not base_url.endswith('/v1'):
             base_url = base_url.rstrip('/') + '/v1'
         
-        # For vLLM server, we don't need an API key, but the client requires one
-        self.client = openai.AsyncOpenAI(
-            api_key="EMPTY",  # Dummy API key for vLLM server
-            base_url=base_url
-        )
+        self.base_url = base_url
         self.model = model
-        logging.info(f"Initialized OpenAI client with base_url={base_url} and model={model}")
         self.loop = AsyncLoopWrapper.GetOrStartLoop()
+        if RequestExecutor._session is None:
+            # The session must be created on the loop that sends the requests
+            RequestExecutor._session = asyncio.run_coroutine_threadsafe(
+                self._create_session(), self.loop
+            ).result()
+        RequestExecutor._session_users += 1
+        self.session = RequestExecutor._session
+        logger.info(f"Initialized HTTP session with base_url={base_url} and model={model}")
         self.request_history = []
 
+        # Only used to count the tokens when the server does not report the usage
+        self.tokenizer = None
+        if tokenizer_name is not None:
+            from transformers import AutoTokenizer
+
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+
+        # Responses to already sent prompts, keyed by the hash of the request.
+        # The warmup always goes through it, the benchmark requests only with cache_identical
+        self.cache_identical = cache_identical
+        self.response_cache: "OrderedDict[bytes, asyncio.Future]" = OrderedDict()
+
+    async def _create_session(self) -> aiohttp.ClientSession:
+        # No connection limit, so that concurrent users never wait for a free
+        # connection, which would inflate the measured TTFT. Every user keeps its
+        # connection open between its rounds, see the open files limit in the README
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=0, limit_per_host=0, keepalive_timeout=60, ttl_dns_cache=300
+            ),
+            timeout=aiohttp.ClientTimeout(total=None),
+            json_serialize=lambda obj: orjson.dumps(obj).decode(),
+        )
+
+    def _count_prompt_tokens(self, messages: List[Dict[str, str]]) -> int:
+        if self.tokenizer.chat_template is not None:
+            return len(
+                self.tokenizer.apply_chat_template(
+                    messages, tokenize=True, add_generation_prompt=True
+                )
+            )
+        prompt = "".join(message["content"] for message in messages)
+        return len(self.tokenizer.encode(prompt, add_special_tokens=False))
+
+    def _count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def close(self):
+        """Release the HTTP session, closed with the last executor.
+
+        Requests must not be in flight anymore.
+        """
+        RequestExecutor._session_users -= 1
+        if RequestExecutor._session_users == 0:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            RequestExecutor._session = None
+
     async def _async_launch_request(self, messages: List[Dict[str, str]],  max_tokens: int, tools=None, 
                                     extra_headers: Optional[Dict[str, str]] = None):
         try:
-            logging.info(f"Sending request to model {self.model} with messages: {messages}")
-            
+            logger.debug("Sending request to %s, %d messages", self.model, len(messages))
+
             # Initialize response tracking variables
             words = ""
             tokens_out = 0
             tokens_prefill = 0
-            start_time = time.time()
+            # Wall-clock time only once, for the summary; the latencies come from
+            # the monotonic high-resolution perf_counter()
+            launch_time = time.time()
+            start_time = time.perf_counter()
             first_token_time = None
 
-            # Flatten messages into a single prompt
-            prompt = ""
-            for msg in messages:
-                role = msg["role"]
-                content = msg["content"]
-                prompt += f"{role}: {content}\n"
-            
-            # Make the request
-            response = await self.client.completions.create(
-                model=self.model,
-                prompt=prompt,
-                stream=True,
-                max_tokens=max_tokens,
-                temperature=0.0,
-                extra_headers=extra_headers,
-                stream_options={"include_usage": True},
-                #tools=[
-                #    {"type": "function", 
-                #     "function": {"name": "tool", "description": tools}
-                #     }],
-                #tool_choice="none"  # Don't auto-select tools, just make them available
-            )
+            payload = {
+                "model": self.model,
+                "messages": messages,
+                "stream": True,
+                "max_tokens": max_tokens,
+                "temperature": 0.0,
+                # The last chunk then carries the token counts
+                "stream_options": {"include_usage": True},
+            }
+
+            # Make the request and process the streaming (server-sent events) response
+            async with self.session.post(
+                f"{self.base_url}/chat/completions", json=payload, headers=extra_headers
+            ) as response:
+                response.raise_for_status()
+                async for data in _iter_sse_data(response.content):
+                    if data == b"[DONE]":
+                        break
+                    chunk = orjson.loads(data)
+
+                    # Handle token counts if available
+                    if chunk.get("usage"):
+                        tokens_out = chunk["usage"]["completion_tokens"]
+                        tokens_prefill = chunk["usage"]["prompt_tokens"]
+
+                    if not chunk.get("choices"):
+                        continue
+
+                    # Handle content
+                    text = chunk["choices"][0]["delta"].get("content")
+                    if text:
+                        if first_token_time is None:
+                            first_token_time = time.perf_counter()
+                        words += text
 
-            # Process the streaming response
-            async for chunk in response:
-                if not chunk.choices:
-                    continue
-                    
-                # Handle content
-                if chunk.choices[0].text is not None:
-                    if first_token_time is None and chunk.choices[0].text != "":
-                        first_token_time = time.time()
-                    words += chunk.choices[0].text
-                
-            # Handle token counts if available
-            if hasattr(chunk, 'usage') and chunk.usage is not None:
-                tokens_out = chunk.usage.completion_tokens
-                tokens_prefill = chunk.usage.prompt_tokens
-
-            # If we didn't get token counts from streaming, try to get them from the final response
-            if tokens_out == 0 or tokens_prefill == 0:
-                print("No token counts from streaming, getting final response")
-                print(f"{tokens_out}, {tokens_prefill}")
-                try:
-                    final_response = await self.client.completions.create(
-                        model=self.model,
-                        prompt=prompt,
-                        stream=False,
-                        max_tokens=max_tokens,
+            # # Calculate timing metrics
+            end_time = time.perf_counter()
+
+            if self.tokenizer is not None:
+                # Tokenized in a worker thread, so that the other streams on the loop
+                # are not blocked and their timings are not skewed
+                loop = asyncio.get_running_loop()
+                if tokens_prefill == 0:
+                    tokens_prefill = await loop.run_in_executor(
+                        None, self._count_prompt_tokens, messages
+                    )
+                if tokens_out == 0 and words:
+                    tokens_out = await loop.run_in_executor(
+                        None, self._count_tokens, words
                     )
-                    if hasattr(final_response, 'usage') and final_response.usage is not None:
-                        tokens_out = final_response.usage.completion_tokens
-                        tokens_prefill = final_response.usage.prompt_tokens
-                except Exception as e:
-                    logging.warning(f"Failed to get token counts from final response: {e}")
 
-            # # Calculate timing metrics
             ttft = first_token_time - start_time if first_token_time else 0
-            generation_time = time.time() - first_token_time if first_token_time else 0
+            generation_time = end_time - first_token_time if first_token_time else 0
 
             return Response(
                 body=words,
@@ -257,15 +358,61 @@ class RequestExecutor:
                 generation_time=generation_time,
                 prompt_tokens=tokens_prefill,
                 generation_tokens=tokens_out,
-                launch_time=start_time,
-                finish_time=time.time(),
+                launch_time=launch_time,
+                finish_time=launch_time + (end_time - start_time),
             )
 
         except Exception as e:
-            logging.error(f"Error in _async_launch_request: {str(e)}")
-            logging.error(f"Request details - model: {self.model}, messages: {messages}")
+            logger.error("Error in _async_launch_request: %s", e)
+            logger.error(
+                "Request details - model: %s, %d messages, %d prompt characters",
+                self.model,
+                len(messages),
+                sum(len(message["content"]) for message in messages),
+            )
             raise
 
+    async def _async_launch_cached_request(
+        self, messages: List[Dict[str, str]], max_tokens: int, tools=None,
+        extra_headers: Optional[Dict[str, str]] = None,
+    ) -> Response:
+        key = hashlib.blake2b(
+            orjson.dumps([messages, max_tokens]), digest_size=16
+        ).digest()
+        cached_future = self.response_cache.get(key)
+        if cached_future is not None:
+            self.response_cache.move_to_end(key)
+            # Identical requests in flight wait for the first one instead of being sent
+            response = await asyncio.shield(cached_future)
+            now = time.time()
+            return replace(
+                response,
+                ttft=0.0,
+                generation_time=0.0,
+                launch_time=now,
+                finish_time=now,
+                cached=True,
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        self.response_cache[key] = future
+        if len(self.response_cache) > self.RESPONSE_CACHE_SIZE:
+            self.response_cache.popitem(last=False)
+        try:
+            response = await self._async_launch_request(
+                messages, max_tokens, tools, extra_headers
+            )
+        except BaseException as e:
+            # Do not cache failures, the next identical request is sent again
+            if self.response_cache.get(key) is future:
+                del self.response_cache[key]
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody waits for it
+            future.exception()
+            raise
+        future.set_result(response)
+        return response
+
     def launch_request(
         self,
         chat_history: ChatHistory,
@@ -279,17 +426,96 @@ class RequestExecutor:
         """
         messages = chat_history.get_messages_for_openai()
         real_callback = lambda x: finish_callback(x.result())
-        future = asyncio.run_coroutine_threadsafe(
-            self._async_launch_request(messages, max_tokens, tools, extra_headers), self.loop
+        launch = (
+            self._async_launch_cached_request
+            if self.cache_identical
+            else self._async_launch_request
         )
+        coro = launch(messages, max_tokens, tools, extra_headers)
+        if _get_running_loop() is self.loop:
+            # Called from the loop itself (the workload driver), no need to hop threads
+            future = self.loop.create_task(coro)
+        else:
+            future = asyncio.run_coroutine_threadsafe(coro, self.loop)
         future.add_done_callback(real_callback)
 
+    def launch_many(
+        self, chat_histories: List[ChatHistory], max_tokens: int, use_cache: bool = False
+    ) -> "concurrent.futures.Future[List[Response]]":
+        """Send all requests concurrently, returns a single future of their responses.
+
+        With use_cache, identical requests are answered from the response cache.
+        """
+        launch = (
+            self._async_launch_cached_request
+            if use_cache or self.cache_identical
+            else self._async_launch_request
+        )
+
+        async def gather_requests():
+            return await asyncio.gather(
+                *[
+                    launch(chat_history.get_messages_for_openai(), max_tokens)
+                    for chat_history in chat_histories
+                ]
+            )
+
+        return asyncio.run_coroutine_threadsafe(gather_requests(), self.loop)
+
+
+def _normalize_newlines(data: bytes) -> bytes:
+    # Lines of a server-sent events stream may end with \r\n, \n or \r
+    return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+
+def _sse_event_data(event: bytes) -> Optional[bytes]:
+    data = [
+        line[len(b"data:"):].strip()
+        for line in event.split(b"\n")
+        if line.startswith(b"data:")
+    ]
+    return b"\n".join(data) if data else None
+
+
+async def _iter_sse_data(content: aiohttp.StreamReader):
+    """Yields the data of every event of a server-sent events stream."""
+    buffer = b""
+    async for raw in content.iter_any():
+        buffer += raw
+        # A trailing \r may be the first half of a \r\n split across two reads
+        pending = b"\r" if buffer.endswith(b"\r") else b""
+        if pending:
+            buffer = buffer[:-1]
+        # Events are separated by a blank line, the last one may be incomplete
+        *events, buffer = _normalize_newlines(buffer).split(b"\n\n")
+        buffer += pending
+        for event in events:
+            data = _sse_event_data(event)
+            if data is not None:
+                yield data
+
+    # The stream may end without a blank line after its last event
+    data = _sse_event_data(_normalize_newlines(buffer))
+    if data is not None:
+        yield data
+
+
+def _get_running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
 
 class UserSession:
 
-    def __init__(self, user_config: UserConfig, app: App = None, use_sharegpt=False, sharegpt_data=None):
+    def __init__(self, user_config: UserConfig, app: App = None, use_sharegpt=False, sharegpt_data=None,
+                 on_finished: Optional[Callable[["UserSession"], None]] = None):
         self.user_config = user_config
         self.app = app
+        # Called once, when the session has finished all its rounds: from the callback
+        # of its last request, or from step() for a session that starts with none left
+        self.on_finished = on_finished
         self.last_request_time = None
         self.chat_history = ChatHistory()
         self.question_id = 0
@@ -304,34 +530,35 @@ class UserSession:
         self.has_unfinished_request = False
         self.last_unfinished_log = 0
 
-        self.prompt_lengths = []
-        self.generation_lengths = []
-        self.ttfts = []
-        self.generation_times = []
-        self.launch_times = []
-        self.finish_times = []
+        # One entry per round, the first _n_completed entries are filled
+        num_rounds = user_config.num_rounds
+        self.prompt_lengths = np.empty(num_rounds, dtype=np.int32)
+        self.generation_lengths = np.empty(num_rounds, dtype=np.int32)
+        self.ttfts = np.empty(num_rounds, dtype=np.float64)
+        self.generation_times = np.empty(num_rounds, dtype=np.float64)
+        self.launch_times = np.empty(num_rounds, dtype=np.float64)
+        self.finish_times = np.empty(num_rounds, dtype=np.float64)
+        self._n_completed = 0
 
         self.finished = False
 
     def _update_result(self, response: Response):
-        self.prompt_lengths.append(response.prompt_tokens)
-        self.generation_lengths.append(response.generation_tokens)
-        self.ttfts.append(response.ttft)
-        self.generation_times.append(response.generation_time)
-        self.launch_times.append(response.launch_time)
-        self.finish_times.append(response.finish_time)
+        i = self._n_completed
+        self.prompt_lengths[i] = response.prompt_tokens
+        self.generation_lengths[i] = response.generation_tokens
+        self.ttfts[i] = response.ttft
+        self.generation_times[i] = response.generation_time
+        self.launch_times[i] = response.launch_time
+        self.finish_times[i] = response.finish_time
+        self._n_completed += 1
 
     def _build_system_prompt(self):
         if self.app:
             return self.app.systemPrompt
-        
-        def gen_dummy_text(length):
-            return " ".join(["hi"] * length)
 
-        dummy_text_sys = gen_dummy_text(self.user_config.system_prompt_len)
-        dummy_text_user = gen_dummy_text(self.user_config.user_info_len)
+        dummy_text_user = _dummy_text(self.user_config.user_info_len)
         system_prompt = (
-            f"Hi, here's some system prompt: {dummy_text_sys}."
+            _dummy_system_prompt_prefix(self.user_config.system_prompt_len)
             + f"For user {self.user_config.user_id}, "
             + f"here are some other context: {dummy_text_user}."
         )
@@ -339,8 +566,9 @@ class UserSession:
 
     def _build_new_question(self):
         self.question_id += 1
-        # Generate a random string of length 2000
-        random_string = ''.join(random.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=200))
+        # A random string defeats exact-prompt caching, any slice of the pool will do
+        start = random.randrange(len(_RAND_POOL) - _RANDOM_STRING_LEN)
+        random_string = _RAND_POOL[start:start + _RANDOM_STRING_LEN]
         return (
             f"Here's question #{self.question_id}: can you tell me "
             + "a new long story with a happy ending? "
@@ -355,43 +583,38 @@ class UserSession:
         return "\n".join(selected_docs)
     
     def _get_all_rag_docs(self):
-        if not self.app or not self.app.ragDocs:
+        if not self.app:
             return ""
-        return "\n".join(self.app.ragDocs)
+        return self.app.joined_rag_docs
 
     def _launch_new_request(self, timestamp: float, request_executor: RequestExecutor):
         if self.use_sharegpt:
             if self.start_with_gpt:
-                prompt = self.sharegpt_data["conversations"][2 * self.question_id + 1][
-                    "value"
-                ]
+                prompt = self.sharegpt_data["values"][2 * self.question_id + 1]
             else:
-                prompt = self.sharegpt_data["conversations"][2 * self.question_id][
-                    "value"
-                ]
+                prompt = self.sharegpt_data["values"][2 * self.question_id]
             self.question_id += 1
         else:
-            rag_docs = self._get_all_rag_docs()
-            prompt = self._build_new_question()
-            prompt = rag_docs + prompt
+            prompt = self._get_all_rag_docs() + self._build_new_question()
         if len(self.chat_history) == 0:
-            prompt = self._build_system_prompt() + prompt
+            # Sent as its own message, so the conversation keeps a stable prefix
+            # that the server can reuse from its prefix cache
+            self.chat_history.on_system_prompt(self._build_system_prompt())
         #print(f"RAG docs: {rag_docs}")
         #prompt = rag_docs + prompt
         self.chat_history.on_user_query(prompt)
+        # Lazy formatting, the prompt is only rendered when DEBUG is enabled
         logger.debug(
-            f"User {self.user_config.user_id} issues request number {self.question_id}: \n {prompt}\n\n"
+            "User %d issues request number %d: \n %s\n\n",
+            self.user_config.user_id,
+            self.question_id,
+            prompt,
         )
         if self.use_sharegpt:
             if self.start_with_gpt:
-                max_tokens = self.sharegpt_data["conversations"][2 * self.question_id][
-                    "num_tokens"
-                ]
+                max_tokens = self.sharegpt_data["max_tokens"][2 * self.question_id]
             else:
-                max_tokens = self.sharegpt_data["conversations"][
-                    2 * self.question_id - 1
-                ]["num_tokens"]
-            max_tokens = min(max_tokens, self.user_config.answer_len)
+                max_tokens = self.sharegpt_data["max_tokens"][2 * self.question_id - 1]
         else:
             max_tokens = self.user_config.answer_len
 
@@ -413,11 +636,24 @@ class UserSession:
         self.chat_history.on_system_response(response.body)
         self.has_unfinished_request = False
         logger.debug(
-            f"User {self.user_config.user_id} finished one request. "
-            f"Prompt tokens: {response.prompt_tokens}, "
-            f"generation tokens: {response.generation_tokens}"
+            "User %d finished one request. Prompt tokens: %d, generation tokens: %d",
+            self.user_config.user_id,
+            response.prompt_tokens,
+            response.generation_tokens,
         )
-        self._update_result(response)
+        # A cached response measures nothing about the server, keep it out of the metrics
+        if not response.cached:
+            self._update_result(response)
+        # Finish right away, the manager only steps the sessions that are due
+        if self.question_id >= self.user_config.num_rounds:
+            self._finish()
+
+    def _finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        if self.on_finished is not None:
+            self.on_finished(self)
 
     def set_internal_state(self, offset: float, timestamp: float):
         """Tell the session is the 'offset' seconds after the start"""
@@ -432,9 +668,10 @@ class UserSession:
         self.last_request_time = timestamp - offset + passed_time
         self.question_id = num_passed_questions
         logger.debug(
-            f"Set internal state for user {self.user_config.user_id}, "
-            f"question_id: {self.question_id}, "
-            f"last_request_time: {self.last_request_time}"
+            "Set internal state for user %d, question_id: %d, last_request_time: %s",
+            self.user_config.user_id,
+            self.question_id,
+            self.last_request_time,
         )
 
     def step(self, timestamp: float, request_executor: RequestExecutor):
@@ -442,7 +679,7 @@ class UserSession:
             self.question_id >= self.user_config.num_rounds
             and not self.has_unfinished_request
         ):
-            self.finished = True
+            self._finish()
             return
 
         if self.last_request_time is None:
@@ -462,17 +699,21 @@ class UserSession:
             self._launch_new_request(timestamp, request_executor)
             return
 
+    def summary_columns(self) -> Dict[str, np.ndarray]:
+        n = self._n_completed
+        return {
+            "prompt_tokens": self.prompt_lengths[:n],
+            "generation_tokens": self.generation_lengths[:n],
+            "ttft": self.ttfts[:n],
+            "generation_time": self.generation_times[:n],
+            "user_id": np.full(n, self.user_config.user_id, dtype=np.int32),
+            "question_id": np.arange(1, n + 1, dtype=np.int32),
+            "launch_time": self.launch_times[:n],
+            "finish_time": self.finish_times[:n],
+        }
+
     def summary(self) -> pd.DataFrame:
-        df = pd.DataFrame()
-        df["prompt_tokens"] = self.prompt_lengths
-        df["generation_tokens"] = self.generation_lengths
-        df["ttft"] = self.ttfts
-        df["generation_time"] = self.generation_times
-        df["user_id"] = self.user_config.user_id
-        df["question_id"] = range(1, len(self.prompt_lengths) + 1)
-        df["launch_time"] = self.launch_times
-        df["finish_time"] = self.finish_times
-        return df
+        return pd.DataFrame(self.summary_columns())
 
 
 class UserSessionManager:
@@ -481,7 +722,15 @@ class UserSessionManager:
         self, workload_config: WorkloadConfig, init_user_id=0, use_sharegpt=False
     ):
         self.workload_config = workload_config
-        self.sessions = []
+        # Active sessions by user id; a dict so finished sessions are removed in O(1)
+        self.sessions: Dict[int, UserSession] = {}
+        # The active sessions again as a structure of arrays, so that step() finds
+        # the sessions that are due with one comparison. At most num_users sessions
+        # are active, a finished session's slot is filled with the last one
+        self._slot_sessions: List[UserSession] = []
+        self._slot_of_user: Dict[int, int] = {}
+        self._last_request_times = np.empty(workload_config.num_users, dtype=np.float64)
+        self._gaps = np.empty(workload_config.num_users, dtype=np.float64)
         self.apps_manager = AppsManager(workload_config.apps_file_path, workload_config.users_per_app)
 
         gap_between_requests_per_user = workload_config.num_users / workload_config.qps
@@ -509,13 +758,23 @@ class UserSessionManager:
             self._load_sharegpt_data()
 
     def _load_sharegpt_data(self):
-        with open("ShareGPT.json", "r", encoding="utf-8") as file:
-            self.sharegpt_data = json.load(file)
+        with open("ShareGPT.json", "rb") as file:
+            raw = orjson.loads(file.read())
+        # Keep only the fields used by the sessions, with max_tokens already capped
+        answer_len = self.workload_config.answer_len
         self.sharegpt_data = [
-            d
-            for d in self.sharegpt_data
+            {
+                "num_round": d["num_round"],
+                "values": [c["value"] for c in d["conversations"]],
+                "max_tokens": [
+                    min(c.get("num_tokens", answer_len), answer_len)
+                    for c in d["conversations"]
+                ],
+            }
+            for d in raw
             if d["num_round"] > 2 * self.workload_config.num_rounds
         ]
+        del raw
         logger.info(f"There are {len(self.sharegpt_data)} users satisfying ")
 
     def _ramp_up(self, timestamp: float, ramp_up_time: float):
@@ -540,30 +799,58 @@ class UserSessionManager:
 
         if self.use_sharegpt:
             user_session = UserSession(
-                user_config, app, self.use_sharegpt, self.sharegpt_data[self.user_id]
+                user_config, app, self.use_sharegpt, self.sharegpt_data[self.user_id],
+                on_finished=self._on_session_finished,
             )
         else:
-            user_session = UserSession(user_config, app, self.use_sharegpt)
-        self.sessions.append(user_session)
+            user_session = UserSession(
+                user_config, app, self.use_sharegpt, on_finished=self._on_session_finished
+            )
+        self.sessions[self.user_id] = user_session
+        self._add_slot(user_session)
         return user_session
 
-    def _remove_finished_sessions(self):
-        sessions_to_remove = [s for s in self.sessions if s.finished]
-        if len(sessions_to_remove) > 0:
-            logger.info(
-                f"Removing {len(sessions_to_remove)} finished sessions, now "
-                f"active users: {len(self.sessions) - len(sessions_to_remove)}"
-            )
-            for session in sessions_to_remove:
-                self.session_summaries.append(session.summary())
-        self.sessions = [s for s in self.sessions if not s.finished]
+    def _add_slot(self, session: UserSession):
+        slot = len(self._slot_sessions)
+        self._slot_sessions.append(session)
+        self._slot_of_user[session.user_config.user_id] = slot
+        # Stepped on the next step, whatever its internal state
+        self._last_request_times[slot] = -np.inf
+        self._gaps[slot] = session.user_config.gap_between_requests
+
+    def _update_slot(self, session: UserSession):
+        slot = self._slot_of_user.get(session.user_config.user_id)
+        if slot is not None and session.last_request_time is not None:
+            self._last_request_times[slot] = session.last_request_time
+
+    def _remove_slot(self, session: UserSession):
+        slot = self._slot_of_user.pop(session.user_config.user_id)
+        last_slot = len(self._slot_sessions) - 1
+        if slot != last_slot:
+            last_session = self._slot_sessions[last_slot]
+            self._slot_sessions[slot] = last_session
+            self._slot_of_user[last_session.user_config.user_id] = slot
+            self._last_request_times[slot] = self._last_request_times[last_slot]
+            self._gaps[slot] = self._gaps[last_slot]
+        self._slot_sessions.pop()
+
+    def _on_session_finished(self, session: UserSession):
+        self.session_summaries.append(session.summary_columns())
+        del self.sessions[session.user_config.user_id]
+        self._remove_slot(session)
+        logger.info(
+            f"Removing finished session of user {session.user_config.user_id}, "
+            f"now active users: {len(self.sessions)}"
+        )
 
     def step(self, timestamp: float, executor: RequestExecutor):
         if self.need_ramp_up:
             self._ramp_up(timestamp, self.ramp_up_time)
 
         if self.start_time is None:
-            self.start_time = timestamp
+            # Wall-clock time, like the launch and finish times in the summary;
+            # timestamp itself comes from the monotonic event loop clock
+            self.start_time = time.time()
 
         if (self.workload_config.num_users > len(self.sessions)) and (timestamp - self.last_user_join > self.gap_between_users):
             new_session = self._create_user_session()
@@ -574,10 +861,15 @@ class UserSessionManager:
                     f"now active users: {len(self.sessions)}"
                 )
 
-        for session in self.sessions:
+        # Only the sessions whose gap has passed can launch a request, or are late
+        num_sessions = len(self._slot_sessions)
+        due = np.flatnonzero(
+            timestamp - self._last_request_times[:num_sessions] > self._gaps[:num_sessions]
+        )
+        # Snapshot, since finishing sessions remove themselves from the slots
+        for session in [self._slot_sessions[slot] for slot in due]:
             session.step(timestamp, executor)
-
-        self._remove_finished_sessions()
+            self._update_slot(session)
 
     @staticmethod
     def ProcessSummary(
@@ -664,10 +956,12 @@ class UserSessionManager:
         if len(self.session_summaries) == 0 and len(self.sessions) == 0:
             return pd.DataFrame()
 
-        df = pd.concat(
-            [s for s in self.session_summaries] + [s.summary() for s in self.sessions]
+        # Concatenate the raw columns of all sessions and build a single DataFrame
+        summaries = self.session_summaries + [s.summary_columns() for s in self.sessions.values()]
+        df = pd.DataFrame(
+            {column: np.concatenate([s[column] for s in summaries]) for column in summaries[0]}
         )
-        pending_queries = len([s for s in self.sessions if s.has_unfinished_request])
+        pending_queries = len([s for s in self.sessions.values() if s.has_unfinished_request])
         start_time = max(self.start_time, start_time)
         end_time = min(end_time, df["finish_time"].max())
         qps = self.workload_config.qps
@@ -680,14 +974,60 @@ class UserSessionManager:
 
 def warmup_engine(executor):
     logger.info("Warming up the engine")
-    for i in range(10):
+    # The same prompt for all the requests, so that only one of them reaches the
+    # server and the others are answered by the response cache
+    chat_histories = []
+    for _ in range(10):
         chat_history = ChatHistory()
-        chat_history.on_user_query(
-            f"WARMUP: Hi, I'm user {i}. Here are some text: {'hi ' * 100}."
-        )
-        executor.launch_request(chat_history, 100, lambda x: None)
+        chat_history.on_user_query(f"WARMUP: Hi, here are some text: {'hi ' * 100}.")
+        chat_histories.append(chat_history)
 
-    AsyncLoopWrapper.WaitLoop()
+    try:
+        executor.launch_many(chat_histories, 100, use_cache=True).result()
+    except Exception as e:
+        # Like a failed benchmark request, a failed warmup does not stop the run
+        logger.error(f"Warmup failed, continuing without it: {e}")
+
+
+async def run_workload(manager, executor, step_interval, log_interval, duration=None):
+    """Step the manager on the event loop until duration seconds have passed.
+
+    Steps and periodic summaries are scheduled with loop.call_later, and the
+    step timestamps come from the monotonic loop.time().
+    """
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    start_time = loop.time()
+    last_summary_time = time.time()
+
+    def step():
+        if finished.done():
+            return
+        try:
+            manager.step(loop.time(), executor)
+        except Exception as e:
+            finished.set_exception(e)
+            return
+        if duration is not None and loop.time() - start_time > duration:
+            finished.set_result(None)
+            return
+        loop.call_later(step_interval, step)
+
+    def log_summary():
+        nonlocal last_summary_time
+        if finished.done():
+            return
+        try:
+            manager.summary(last_summary_time, time.time())
+        except Exception as e:
+            finished.set_exception(e)
+            return
+        last_summary_time = time.time()
+        loop.call_later(log_interval, log_summary)
+
+    loop.call_soon(step)
+    loop.call_later(log_interval, log_summary)
+    await finished
 
 
 def parse_arguments() -> WorkloadConfig:
@@ -731,6 +1071,20 @@ def parse_arguments() -> WorkloadConfig:
         required=True,
         help="Base URL of the serving engine endpoint",
     )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default=None,
+        help="HuggingFace tokenizer used to count the tokens of the requests "
+        "whose usage is not reported by the server (requires transformers)",
+    )
+    parser.add_argument(
+        "--cache-identical",
+        action="store_true",
+        default=False,
+        help="Answer benchmark requests identical to an already sent one from a "
+        "client-side cache and leave them out of the metrics (the warmup always uses the cache)",
+    )
     parser.add_argument(
         "--time",
         type=int,
@@ -763,7 +1117,9 @@ def parse_arguments() -> WorkloadConfig:
         "--apps-file",
         type=str,
         default="Apps.json",
-        help="Path to the Apps.json file that contains all app data",
+        help="Path to the Apps.json file that contains all app data "
+        "(files ending with .ndjson or .jsonl are read as one app per line, "
+        "and .gz files are decompressed)",
     )
     parser.add_argument(
         "--users-per-app",
@@ -807,8 +1163,19 @@ def main():
     args = parse_arguments()
     step_interval = 0.1
 
+    # Must happen before the executor starts the asyncio loop, so that the loop is created by uvloop
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Using uvloop as the asyncio event loop")
+    except ImportError:
+        logger.info("uvloop is not installed, using the default asyncio event loop")
+
     executor = RequestExecutor(
-        base_url=args.base_url, model=args.model
+        base_url=args.base_url,
+        model=args.model,
+        tokenizer_name=args.tokenizer,
+        cache_identical=args.cache_identical,
     )
 
     warmup_engine(executor)
@@ -829,25 +1196,18 @@ def main():
         workload_config, init_user_id=args.init_user_id, use_sharegpt=args.sharegpt
     )
 
-    num_steps = 0
-    start_time = time.time()
-    last_summary_time = start_time
+    workload = asyncio.run_coroutine_threadsafe(
+        run_workload(manager, executor, step_interval, args.log_interval, args.time),
+        AsyncLoopWrapper.GetLoop(),
+    )
     try:
-        while True:
-            num_steps += 1
-            manager.step(time.time(), executor)
-            time.sleep(step_interval)
-
-            if time.time() - last_summary_time > args.log_interval:
-                manager.summary(last_summary_time, time.time())
-                last_summary_time = time.time()
-
-            if args.time is not None and time.time() - start_time > args.time:
-                break
-
+        workload.result()
     except KeyboardInterrupt:
         logger.info("Interrupted, waiting for the final result")
+        workload.cancel()
 
+    AsyncLoopWrapper.WaitLoop()
+    executor.close()
     AsyncLoopWrapper.StopLoop()
 
     logger.info(f"Finished benchmarking, dumping summary to {args.output}")
@@ -162,6 +162,11 @@ class RequestExecutor:
 
                 # Process the streaming response
                 async for chunk in response:
+                    # The usage arrives in the last chunk, which has no choices
+                    if chunk.usage is not None:
+                        tokens_out = chunk.usage.completion_tokens
+                        tokens_prefill = chunk.usage.prompt_tokens
+
                     if not chunk.choices:
                         continue
                         
@@ -187,6 +192,11 @@ class RequestExecutor:
                 
                 # Process the streaming response
                 async for chunk in response:
+                    # The usage arrives in the last chunk, which has no choices
+                    if chunk.usage is not None:
+                        tokens_out = chunk.usage.completion_tokens
+                        tokens_prefill = chunk.usage.prompt_tokens
+
                     if not chunk.choices:
                         continue
                         
@@ -195,36 +205,6 @@ class RequestExecutor:
                         if first_token_time is None:
                             first_token_time = time.time()
                         words += chunk.choices[0].text
-            
-            # Handle token counts if available
-            if hasattr(chunk, 'usage') and chunk.usage is not None:
-                tokens_out = chunk.usage.completion_tokens
-                tokens_prefill = chunk.usage.prompt_tokens
-
-            # If we didn't get token counts from streaming, try to get them from the final response
-            if tokens_out == 0 or tokens_prefill == 0:
-                print("No token counts from streaming, getting final response")
-                print(f"{tokens_out}, {tokens_prefill}")
-                try:
-                    if use_chat_completions:
-                        final_response = await self.client.chat.completions.create(
-                            model=self.model,
-                            messages=messages,
-                            stream=False,
-                        )
-                    else:
-                        prompt = "\n".join([f"{msg['role'].upper()}: {msg['content']}" for msg in messages])
-                        final_response = await self.client.completions.create(
-                            model=self.model,
-                            prompt=prompt,
-                            stream=False,
-                        )
-                        
-                    if hasattr(final_response, 'usage') and final_response.usage is not None:
-                        tokens_out = final_response.usage.completion_tokens
-                        tokens_prefill = final_response.usage.prompt_tokens
-                except Exception as e:
-                    logging.warning(f"Failed to get token counts from final response: {e}")
 
             # # Calculate timing metrics
             ttft = first_token_time - start_time if first_token_time else 0